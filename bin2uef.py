@@ -3,21 +3,24 @@
 import sys
 
 from argparse import ArgumentParser
-from struct import pack
+from binascii import crc_hqx
+from struct import Struct, pack
+
+
+CARRIER_LONG = pack('<HIH', 0x0110, 2, 1500)
+CARRIER_SHORT = pack('<HIH', 0x0110, 2, 600)
+DUMMY_BYTE = pack('<HIB', 0x0100, 1, 0xdc)
+INTEGER_GAP = pack('<HIH', 0x0112, 2, 600)
+
+CHUNK = Struct('<HI')
+HEADER = Struct('<BIIHHBI')
+CRC = Struct('>H')
 
 
 def crc(bytes):
-    crc = 0
-    for c in bytes:
-        crc = ((c ^ (crc >> 8)) << 8) | (crc & 0x00FF)
-        for _ in range(8):
-            if crc & 0x8000:
-                crc = crc ^ 0x0810
-                t = 1
-            else:
-                t = 0
-            crc = (crc * 2 + t) & 0xFFFF
-    return crc
+    # The tape block CRC is CRC-16/XMODEM: polynomial 0x1021, initial value
+    # zero, no reflection. That is exactly what binascii.crc_hqx computes.
+    return crc_hqx(bytes, 0)
 
 
 def parse_args():
@@ -42,19 +45,28 @@ def parse_args():
 def main():
     args = parse_args()
 
+    # Collect the many small writes below into a large buffer, rather than
+    # going through the default stdout buffer.
+    out = open(sys.stdout.fileno(), 'wb', buffering=1 << 20, closefd=False)
+
     # magic value
-    sys.stdout.buffer.write(b'UEF File!\x00')
+    out.write(b'UEF File!\x00')
 
     # spec version 0.1
-    sys.stdout.buffer.write(b'\x01\x00')
+    out.write(b'\x01\x00')
 
     # carrier tone
-    sys.stdout.buffer.write(pack('<HIH', 0x0110, 2, 1500))
-    sys.stdout.buffer.write(pack('<HIB', 0x0100, 1, 0xdc))
-    sys.stdout.buffer.write(pack('<HIH', 0x0110, 2, 1500))
+    out.write(CARRIER_LONG)
+    out.write(DUMMY_BYTE)
+    out.write(CARRIER_LONG)
 
     data = sys.stdin.buffer.read()
 
+    # The header is the name followed by the fixed fields, which are packed
+    # in place for every block.
+    name = str.encode(args.name[:10])
+    header = bytearray(name) + bytearray(HEADER.size)
+
     block_nr = 0
     while block_nr * 256 < len(data):
         i = block_nr * 256
@@ -65,29 +77,29 @@ def main():
         block_flag = 0x80 if j == len(data) else 0
 
         # construct data header
-        header = str.encode(args.name[:10])
-        header += pack('<BIIHHBI', 0, args.load_addr, args.exec_addr, block_nr,
-                       len(block), block_flag, 0)
+        HEADER.pack_into(header, len(name), 0, args.load_addr, args.exec_addr,
+                         block_nr, len(block), block_flag, 0)
 
         # write data chunk lead
-        sys.stdout.buffer.write(
-            pack('<HI', 0x0100, 1 + len(header) + 2 + len(block) + 2))
+        out.write(CHUNK.pack(0x0100, 1 + len(header) + 2 + len(block) + 2))
 
         # write data
-        sys.stdout.buffer.write(b'*')
-        sys.stdout.buffer.write(header)
-        sys.stdout.buffer.write(pack('>H', crc(header)))
-        sys.stdout.buffer.write(block)
-        sys.stdout.buffer.write(pack('>H', crc(block)))
+        out.write(b'*')
+        out.write(header)
+        out.write(CRC.pack(crc(header)))
+        out.write(block)
+        out.write(CRC.pack(crc(block)))
 
         # carrier tone
-        sys.stdout.buffer.write(pack('<HIH', 0x0110, 2, 600))
+        out.write(CARRIER_SHORT)
 
         block_nr += 1
 
     # integer gap
-    sys.stdout.buffer.write(pack('<HIH', 0x0112, 2, 600))
+    out.write(INTEGER_GAP)
+
+    out.flush()
+
 
-    
 if __name__ == '__main__':
     main()
@@ -1,10 +1,11 @@
 #!/usr/bin/env python3
 
 from argparse  import ArgumentParser
-from functools import reduce
+from array     import array
+from functools import lru_cache
+from itertools import chain, repeat
 from math      import pi, radians, sin
-from operator  import xor
-from struct    import pack, unpack
+from struct    import Struct
 
 import gzip
 import io
@@ -15,6 +16,14 @@ import zipfile
 
 args = None
 
+CHUNK = Struct('<HI')
+SHORT = Struct('<H')
+TWO_SHORTS = Struct('<HH')
+FLOAT = Struct('<f')
+TAPE_FORMAT = Struct('<Bcb')
+CYCLE_COUNT = Struct('<BH')
+WAV_HEADER = Struct('<4sI4s4sIhhIIhh4sI')
+
 
 def parse_args():
     parser = ArgumentParser()
@@ -53,8 +62,29 @@ def open_uef(stream):
     return open_gzip(open_zip(io.BytesIO(stream.read())))
 
 
+# The bits of every byte value, least significant first.
+BITS = [tuple(1 if byte & (1 << i) else 0 for i in range(8))
+        for byte in range(256)]
+
+
 def as_bits(byte):
-    return [1 if byte & (1 << i) else 0 for i in range(8)]
+    return BITS[byte]
+
+
+# Tapes tend to switch between the same few frequencies and phases, so keep
+# the samples of recent ones around.
+@lru_cache(maxsize=64)
+def synthesize(freq, phase, ph0, ph1, amp):
+    n = int(round(44100 * (ph1 - ph0) / (2 * pi) // freq))
+    if amp == 0:  # Silence, no need for any sines.
+        return b'\x00\x00' * n
+    start = phase + ph0
+    step = 2 * pi * freq / 44100
+    points = [amp * sin(start + step * t) for t in range(n)]
+    samples = array('h', [int(p) for p in points])
+    if sys.byteorder == 'big':
+        samples.byteswap()
+    return samples.tobytes()
 
 
 def read_chunks(stream):
@@ -62,13 +92,9 @@ def read_chunks(stream):
     phase = radians(180)
 
     def sample(freq, ph0, ph1, amp=32767):
-        n = int(round(44100 * (ph1 - ph0) / (2 * pi) // freq))
-        points = [amp * sin(phase + ph0 + 2 * pi * freq * t / 44100)
-                  for t in range(n)]
-        fmt = '<' + 'h' * n
-        return pack(fmt, *[int(p) for p in points])
+        return synthesize(freq, phase, ph0, ph1, amp)
 
-    def wave(x):
+    def render(x):
         if x == 'SL':  # Slow Low pulse.
             return sample(frequency, 0, pi)
 
@@ -96,109 +122,155 @@ def read_chunks(stream):
         if x == '.':  # Silence.
             return sample(frequency, 0, 2 * pi, 0)
 
-    data = io.BytesIO()
-    with open_uef(stream) as uef:
-        assert uef.read(10) == b'UEF File!\x00'
-        uef.read(2)
-        while True:
-            header = uef.read(6)
-            if len(header) == 0:
-                break
+    # Sample data by wave() argument, only valid for the current frequency
+    # and phase.
+    waves = {}
+
+    def wave(x):
+        if x not in waves:
+            waves[x] = render(x)
+        return waves[x]
+
+    # The pieces of sample data, largely shared cached waveforms. They are
+    # written out one by one, never joined into a single copy. Carriers and
+    # gaps repeat a reference to one cached block of cycles rather than
+    # materialising the whole tone, so memory use stays a fraction of the
+    # output size while writes stay large.
+    data = []
+
+    # 256 repetitions of a wave() by its argument, with the same validity.
+    blocks = {}
+
+    def write_repeated(x, n):
+        if n <= 0:  # As with a bytes multiply, nothing for a negative count.
+            return
+        if x not in blocks:
+            blocks[x] = wave(x) * 256
+        count, rest = divmod(n, 256)
+        data.extend(repeat(blocks[x], count))
+        data.extend(repeat(wave(x), rest))
+
+    # Sample data of a byte including its start, parity and stop bits, by
+    # tape format and byte value. Only valid for the current frequency and
+    # phase.
+    frames = {}
+
+    def write_frames(block, data_bits, parity, stop_bits):
+        cache = frames.setdefault((data_bits, parity, stop_bits), {})
+        for byte in set(block).difference(cache):
+            bits = as_bits(byte)[:data_bits]
+            frame = [wave(0)]
+            for bit in bits:
+                frame.append(wave(bit))
+            odd = bin(byte & ((1 << data_bits) - 1)).count('1') & 1
+            if parity == b'E':
+                frame.append(wave(odd))
+            elif parity == b'O':
+                frame.append(wave(1 - odd))
+            frame.append(wave(1) * abs(stop_bits))
+            cache[byte] = b''.join(frame)
+        data.extend(map(cache.__getitem__, block))
 
-            identifier, length = unpack('<HI', header)
-            chunk = uef.read(length)
+    with open_uef(stream) as uef:
+        # Read the whole tape at once, and look at its chunks through
+        # memoryview slices rather than reading each one separately.
+        tape = memoryview(uef.read())
+        assert tape[:10] == b'UEF File!\x00'
+        offset = 12
+        while offset < len(tape):
+            identifier, length = CHUNK.unpack_from(tape, offset)
+            offset += CHUNK.size
+            chunk = tape[offset:offset + length]
+            offset += length
 
             if identifier == 0x100:  # Implicit start/stop bit tape data block.
-                for byte in chunk:
-                    data.write(wave(0))
-                    for bit in as_bits(byte):
-                        data.write(wave(bit))
-                    data.write(wave(1))
+                write_frames(chunk, 8, b'N', 1)
 
             elif identifier == 0x104:  # Defined tape format data block.
-                data_bits, parity, stop_bits = unpack('<Bcb', chunk[:3])
-                for byte in chunk[3:]:
-                    data.write(wave(0))
-                    bits = as_bits(byte)[:data_bits]
-                    for bit in bits:
-                        data.write(wave(bit))
-                    if parity == b'E':
-                        data.write(wave(reduce(xor, bits, 0)))
-                    elif parity == b'O':
-                        data.write(wave(1 - reduce(xor, bits, 0)))
-                    data.write(wave(1) * abs(stop_bits))
+                data_bits, parity, stop_bits = TAPE_FORMAT.unpack_from(chunk)
+                write_frames(chunk[3:], data_bits, parity, stop_bits)
                 if stop_bits < 0:
-                    data.write(wave('FC'))
+                    data.append(wave('FC'))
 
             elif identifier == 0x110:  # Carrier tone.
-                cycles = unpack('<H', chunk)[0]
-                data.write(wave('FC') * cycles * args.stretch)
+                cycles = SHORT.unpack_from(chunk)[0]
+                write_repeated('FC', cycles * args.stretch)
 
             elif identifier == 0x111:  # Carrier tone with dummy byte.
-                n, m = unpack('<HH', chunk)
-                data.write(wave(1) * n)
+                n, m = TWO_SHORTS.unpack_from(chunk)
+                write_repeated(1, n)
                 for b in [0, 1, 0, 1, 0, 1, 0, 1, 0, 1]:
-                    data.write(wave(b))
-                data.write(wave(1) * m)
+                    data.append(wave(b))
+                write_repeated(1, m)
 
             elif identifier == 0x112:  # Integer gap.
-                cycles = unpack('<H', chunk)[0]
-                data.write(wave('.') * cycles)
+                cycles = SHORT.unpack_from(chunk)[0]
+                write_repeated('.', cycles)
 
             elif identifier == 0x113:  # Change of base frequency.
-                frequency = unpack('<f', chunk)[0]
+                frequency = FLOAT.unpack_from(chunk)[0]
+                waves.clear()
+                blocks.clear()
+                frames.clear()
 
             elif identifier == 0x114:  # Security cycles.
-                lower, upper = unpack('<BH', chunk[:3])
-                cycles = upper << 8 + lower
-                bits = reduce(lambda bs, b: bs + as_bits(b), chunk[5:], [])
+                lower, upper = CYCLE_COUNT.unpack_from(chunk)
+                # Cycle bits are stored most significant bit first, unlike
+                # data bytes. Never read past the bits actually there.
+                bits = list(chain.from_iterable(as_bits(byte)[::-1]
+                                                for byte in chunk[5:]))
+                cycles = min((upper << 8) | lower, len(bits))
                 index = 0
-                if chunk[3] == b'P':
-                    data.write(wave('FH' if data[0] else 'SH'))
-                    index += 1
-                    cycles -= 1
-                for _ in range(cycles, 1, -1):
-                    data.write(wave('FC' if bits[index] else 'SC'))
+                if cycles >= 1 and chunk[3] == ord('P'):
+                    data.append(wave(('SH', 'FH')[bits[0]]))
                     index += 1
                     cycles -= 1
-                if cycles == 1:
-                    if chunk[4] == b'P':
-                        data.write(wave('FL' if bits[index] else 'SL'))
+                if cycles > 1:
+                    cycle = (wave('SC'), wave('FC'))
+                    data.extend(map(cycle.__getitem__,
+                                    bits[index:index + cycles - 1]))
+                    index += cycles - 1
+                if cycles >= 1:
+                    if chunk[4] == ord('P'):
+                        data.append(wave(('SL', 'FL')[bits[index]]))
                     else:
-                        data.write(wave('FC' if bits[index] else 'SC'))
+                        data.append(wave(('SC', 'FC')[bits[index]]))
 
             elif identifier == 0x115:  # Phase change.
-                phase = radians(unpack('<H', chunk)[0])
+                phase = radians(SHORT.unpack_from(chunk)[0])
+                waves.clear()
+                blocks.clear()
+                frames.clear()
 
             elif identifier == 0x116:  # Floating point gap.
-                secs = unpack('<f', chunk)[0]
-                data.write(wave('.') * int(round(frequency * secs)))
+                secs = FLOAT.unpack_from(chunk)[0]
+                write_repeated('.', int(round(frequency * secs)))
 
-        data.seek(0)
-        return data.read()
+        return data
 
 
 def write_wav(data, stream):
-    stream.write(b'RIFF')
-    stream.write(pack('<I', 4 + 8 + 16 + 8 + len(data)))
-    stream.write(b'WAVE')
-    stream.write(b'fmt ')
-    stream.write(pack('<I', 16))         # PCM
-    stream.write(pack('<h', 1))          # PCM
-    stream.write(pack('<h', 1))          # Channels
-    stream.write(pack('<I', 44100))      # Sample rate
-    stream.write(pack('<I', 44100 * 2))  # Byte rate
-    stream.write(pack('<h', 2))          # Block align
-    stream.write(pack('<h', 16))         # Bits per sample
-    stream.write(b'data')
-    stream.write(pack('<I', len(data)))
-    stream.write(data)
+    size = sum(map(len, data))
+    stream.write(WAV_HEADER.pack(
+        b'RIFF', 4 + 8 + 16 + 8 + size, b'WAVE',
+        b'fmt ',
+        16,                       # PCM
+        1,                        # PCM
+        1,                        # Channels
+        44100,                    # Sample rate
+        44100 * 2,                # Byte rate
+        2,                        # Block align
+        16,                       # Bits per sample
+        b'data', size))
+    stream.writelines(data)
 
 
 def main():
     global args
     args = parse_args()
-    write_wav(read_chunks(sys.stdin.buffer), sys.stdout.buffer)
+    out = open(sys.stdout.fileno(), 'wb', buffering=1 << 20, closefd=False)
+    write_wav(read_chunks(sys.stdin.buffer), out)
+    out.flush()
 
 
 if __name__ == '__main__':
@@ -1,8 +1,9 @@
 #!/usr/bin/env python3
 
-from struct import pack, unpack
+from argparse import ArgumentParser
+from struct import Struct
 
-import io
+import re
 import sys
 
 
@@ -10,139 +11,210 @@ class SyncError(Exception):
     pass
 
 
+CHUNK = Struct('<HI')
+GAP_CHUNK = Struct('<HIf')
+CARRIER_CHUNK = Struct('<HIH')
+WAV_HEADER = Struct('<4sI4s4sIhhIIhh4sI')
+
+NON_PRINTABLE = re.compile(b'[^ -~]')
+
+# Sign of a sample by its code in SampleStream.signs.
+SIGNS = (0, +1, -1)
+
+# Matches a run of samples of the same sign, by sign.
+RUNS = {sgn: re.compile(re.escape(bytes([sgn % 3])) + b'*') for sgn in SIGNS}
+
+
+def parse_args():
+    parser = ArgumentParser()
+    parser.add_argument('-v', '--verbose', action='store_true',
+                        help='print the chunks found to standard error')
+    return parser.parse_args()
+
+
+# Sign codes of a sample by its high byte, ignoring the low byte.
+HIGH_SIGNS = bytes([0] + [1] * 127 + [2] * 128)
+# 1 for a non-zero byte.
+NON_ZERO = bytes([0] + [1] * 255)
+# 1 for a zero byte.
+ZERO = bytes([1] + [0] * 255)
+
+
+# Samples worked out at a time, which bounds the size of the temporaries.
+BLOCK = 1 << 16
+
+
+class SampleStream(object):
+    # The signs of all samples, worked out up front, with a cursor into them.
+    def __init__(self, stream):
+        # One byte per sample: 0 for zero, 1 for positive, 2 for negative.
+        # The samples are little-endian, so the sign follows from the high
+        # byte, unless that is zero and the low byte decides between zero
+        # and positive. Both cases are combined as large integers holding a
+        # byte per sample, which sweeps over a whole block of samples at once
+        # rather than going one by one. Only one block of samples is ever
+        # held in memory.
+        self.signs = bytearray()
+        while True:
+            data = stream.read(BLOCK * 2)
+            low, high = data[0:len(data) // 2 * 2:2], data[1::2]
+            if not high:
+                break
+            signs = (int.from_bytes(high.translate(HIGH_SIGNS), 'little') |
+                     int.from_bytes(low.translate(NON_ZERO), 'little') &
+                     int.from_bytes(high.translate(ZERO), 'little'))
+            self.signs += signs.to_bytes(len(high), 'little')
+        self.pos = 0
+
+
 def secs(start_pos, end_pos):
-    byte_count = end_pos - start_pos
-    sample_count = byte_count / 2
+    sample_count = end_pos - start_pos
     return sample_count / 44100.0
 
 
 class GapChunk(object):
+    __slots__ = ('start', 'end')
+
     def __repr__(self):
         return '<Gap {:.1f} secs>'.format(secs(self.start, self.end))
 
-    def write(self, stream):
-        stream.write(pack('<HIf', 0x116, 4, secs(self.start, self.end)))
+    def write(self, out):
+        out += GAP_CHUNK.pack(0x116, 4, secs(self.start, self.end))
 
 
 class CarrierChunk(object):
+    __slots__ = ('start', 'end')
+
     def __repr__(self):
         return '<Carrier {:.1f} secs>'.format(secs(self.start, self.end))
 
-    def write(self, stream):
-        cycles = int(secs(self.start, self.end) * 2400)
-        stream.write(pack('<HIH', 0x110, 2, cycles))
+    def write(self, out):
+        # Exact integer arithmetic, no need to go through seconds.
+        cycles = (self.end - self.start) * 2400 // 44100
+        out += CARRIER_CHUNK.pack(0x110, 2, cycles)
 
 
 class DataChunk(object):
+    __slots__ = ('start', 'end', 'bytes')
+
     def __repr__(self):
         return '<Data {} bytes "{}">'.format(len(self.bytes), self.filename)
 
     @property
     def filename(self):
-        s = ''
-        for x in self.bytes:
-            if x == 0:
-                break
-            s += chr(x) if (32 <= x < 127) else '&{:02x}'.format(x)
-        return s
-
-    def write(self, stream):
-        stream.write(pack('<HI', 0x100, len(self.bytes)))
-        for byte in self.bytes:
-            stream.write(pack('B', byte))
+        name = self.bytes.split(b'\x00', 1)[0]
+        return NON_PRINTABLE.sub(lambda m: b'&%02x' % m.group()[0],
+                                 name).decode('ascii')
 
+    def write(self, out):
+        out += CHUNK.pack(0x100, len(self.bytes))
+        out += self.bytes
 
-def byte(bits):
-    n = 0
-    for pos, bit in enumerate(bits):
-        n += bit * 2**pos
-    return n
 
-
-def get_sample(stream):
-    sample = stream.read(2)
-    if not sample:
+def get_sign(stream):
+    if stream.pos >= len(stream.signs):
         raise EOFError()
 
-    return unpack('<h', sample)[0] / 32768.0
-
-
-def sign(x):
-    if x < 0:
-        return -1
-    if x > 0:
-        return +1
-    return 0
+    stream.pos += 1
+    return SIGNS[stream.signs[stream.pos - 1]]
 
 
 def unget(stream, length=1):
-    stream.seek(-length * 2, io.SEEK_CUR)
+    stream.pos -= length
 
 
 def get_pulse(stream):
-    first = get_sample(stream)
-    samples = [first]
+    length = 1
 
     # Figure out the sign of our pulse. If the first sample is zero,
     # we look at the next to figure out our sign, or whether we are
     # silence.
-    sgn = sign(first)
+    sgn = get_sign(stream)
     if sgn == 0:
-        sample = get_sample(stream)
-        samples.append(sample)
-        if sign(sample) != 0:
-            sgn = sign(sample)
-
-    # Consume the pulse.
-    sample = get_sample(stream)
-    while sign(sample) == sgn:
-        samples.append(sample)
-        sample = get_sample(stream)
+        length += 1
+        sgn = get_sign(stream)
+
+    # Consume the pulse, finding the end of the run of same-signed samples
+    # in one go.
+    end = RUNS[sgn].match(stream.signs, stream.pos).end()
+    length += end - stream.pos
+    if end >= len(stream.signs):
+        stream.pos = end
+        raise EOFError()
 
-    # If the final sample is not zero, then its sign has flipped
-    # and we unread it.
-    if sign(sample) != 0:
-        unget(stream)
+    # If the final sample is not zero, then its sign has flipped and we
+    # leave it for the next pulse. Look at it in place rather than reading
+    # and unreading it.
+    stream.pos = end + 1 if stream.signs[end] == 0 else end
 
-    return sgn, samples
+    return sgn, length
 
 
 def skip_header(stream):
-    assert stream.read(4) == b'RIFF'
-    stream.read(4)
-    assert stream.read(4) == b'WAVE'
-    assert stream.read(4) == b'fmt '
-    assert unpack('<I', stream.read(4))[0] == 16         # PCM
-    assert unpack('<h', stream.read(2))[0] == 1          # PCM
-    assert unpack('<h', stream.read(2))[0] == 1          # Channels
-    assert unpack('<I', stream.read(4))[0] == 44100      # Sample rate
-    assert unpack('<I', stream.read(4))[0] == 44100 * 2  # Byte rate
-    assert unpack('<h', stream.read(2))[0] == 2          # Block align
-    assert unpack('<h', stream.read(2))[0] == 16         # Bits per sample
-    assert stream.read(4) == b'data'
-    stream.read(4)
+    # Check the header in one go.
+    header = stream.read(WAV_HEADER.size)
+    assert len(header) == WAV_HEADER.size
+    (riff, _, wave, fmt, fmt_size, pcm, channels, sample_rate, byte_rate,
+     block_align, bits, data_id, _) = WAV_HEADER.unpack(header)
+    assert riff == b'RIFF'
+    assert wave == b'WAVE'
+    assert fmt == b'fmt '
+    assert fmt_size == 16           # PCM
+    assert pcm == 1                 # PCM
+    assert channels == 1            # Channels
+    assert sample_rate == 44100     # Sample rate
+    assert byte_rate == 44100 * 2   # Byte rate
+    assert block_align == 2         # Block align
+    assert bits == 16               # Bits per sample
+    assert data_id == b'data'
+
+
+def read_any_cycle(stream):
+    # Read a cycle of any frequency, and tell where it started so it can be
+    # unread exactly. The pulse lengths leave out a trailing zero sample, so
+    # ungetting them could stop short. If the two pulses do not make up a
+    # proper cycle, nothing is read and the frequency is None.
+    start = stream.pos
+    sgn1, length1 = get_pulse(stream)
+    sgn2, length2 = get_pulse(stream)
+
+    if sgn2 != -sgn1 or max(length1, length2) / min(length1, length2) > 1.6:
+        stream.pos = start
+        return None, start
+
+    return int(44100 / (length1 + length2)), start
+
+
+def try_read_cycle(stream, expected_freq):
+    # Read a cycle of the expected frequency and tell whether that worked,
+    # leaving the stream untouched if not. Scanning for a carrier fails far
+    # more often than it succeeds, so this does not raise.
+    freq, start = read_any_cycle(stream)
+    if freq is None:
+        return False
+    if abs(freq - expected_freq) > 500:
+        stream.pos = start
+        return False
+    return True
 
 
 def read_cycle(stream, expected_freq):
-    sgn1, samples1 = get_pulse(stream)
-    sgn2, samples2 = get_pulse(stream)
-
-    length1 = len(samples1)
-    length2 = len(samples2)
+    if not try_read_cycle(stream, expected_freq):
+        raise SyncError('expected {}'.format(expected_freq))
 
-    if sgn2 != -sgn1:
-        unget(stream, length1 + length2)
-        raise SyncError('phase')
 
-    ratio = max(length1, length2) / min(length1, length2)
-    if ratio > 1.6:
-        unget(stream, length1 + length2)
-        raise SyncError('ratio')
-
-    freq = int(44100 / (length1 + length2))
-    if abs(freq - expected_freq) > 500:
-        unget(stream, length1 + length2)
-        raise SyncError('frequency {} {}'.format(freq, expected_freq))
+def read_slow_or_fast(stream):
+    # Read a single cycle and tell whether it is a slow (1200 Hz) or a fast
+    # (2400 Hz) one, without having to unread and read it again to try the
+    # other.
+    freq, start = read_any_cycle(stream)
+    if freq is None:
+        raise SyncError('cycle')
+    for expected_freq in [1200, 2400]:
+        if abs(freq - expected_freq) <= 500:
+            return expected_freq
+    stream.pos = start
+    raise SyncError('frequency {}'.format(freq))
 
 
 def read_zero(stream):
@@ -154,14 +226,22 @@ def read_one(stream):
     read_cycle(stream, 2400)
 
 
+def read_bit(stream):
+    # A zero is one slow cycle, a one is two fast cycles.
+    if read_slow_or_fast(stream) == 1200:
+        return 0
+    read_cycle(stream, 2400)
+    return 1
+
+
 def state_sync(stream, chunks):
     chunks.append(GapChunk())
-    chunks[-1].start = stream.tell()
+    chunks[-1].start = stream.pos
 
     try:
         while True:
-            sgn, samples = get_pulse(stream)
-            if len(samples) not in [8, 9, 10, 16, 17, 18, 19]:
+            sgn, length = get_pulse(stream)
+            if length not in [8, 9, 10, 16, 17, 18, 19]:
                 # Too short or too long.
                 continue
             if sgn >= 0:
@@ -169,27 +249,25 @@ def state_sync(stream, chunks):
                 continue
 
             # Rewind and try to read a carrier tone.
-            unget(stream, len(samples))
-            try:
-                read_cycle(stream, 2400)
+            unget(stream, length)
+            if try_read_cycle(stream, 2400):
                 break
-            except SyncError:
-                # Skip over what we just read.
-                for _ in samples:
-                    get_sample(stream)
 
-        chunks[-1].end = stream.tell()
+            # Skip over what we just read.
+            stream.pos += length
+
+        chunks[-1].end = stream.pos
 
-        return 'state_carrier'
+        return state_carrier
 
     except EOFError:
-        chunks[-1].end = stream.tell()
+        chunks[-1].end = stream.pos
         return None
 
 
 def state_carrier(stream, chunks):
     chunks.append(CarrierChunk())
-    chunks[-1].start = chunks[-1].end = stream.tell()
+    chunks[-1].start = chunks[-1].end = stream.pos
 
     try:
         # A byte consists of a start bit (0), eight data bits, and a stop bit
@@ -199,38 +277,30 @@ def state_carrier(stream, chunks):
         for _ in range(19):
             read_cycle(stream, 2400)
 
-        try:
-            # Consume the remainder of the carrier tone.
-            while True:
-                read_cycle(stream, 2400)
-        except SyncError:
+        # Consume the remainder of the carrier tone.
+        while try_read_cycle(stream, 2400):
             pass
 
-        chunks[-1].end = stream.tell()
+        chunks[-1].end = stream.pos
 
         # Read a start bit.
         read_zero(stream)
 
-        return 'state_byte'
+        return state_byte
 
     except EOFError:
-        chunks[-1].end = stream.tell()
+        chunks[-1].end = stream.pos
         return None
 
 
 def state_byte(stream, chunks):
-    start = stream.tell()
+    start = stream.pos
 
-    bits = []
+    value = 0
 
-    # Read all eight bits.
-    for _ in range(8):
-        try:
-            read_zero(stream)
-            bits.append(0)
-        except SyncError:
-            read_one(stream)
-            bits.append(1)
+    # Read all eight bits, least significant first.
+    for pos in range(8):
+        value |= read_bit(stream) << pos
 
     # Read the stop bit.
     read_one(stream)
@@ -238,40 +308,43 @@ def state_byte(stream, chunks):
     if not (chunks and isinstance(chunks[-1], DataChunk)):
         chunks.append(DataChunk())
         chunks[-1].start = start
-        chunks[-1].bytes = []
-    chunks[-1].end = stream.tell()
-    chunks[-1].bytes.append(byte(bits))
+        chunks[-1].bytes = bytearray()
+    chunks[-1].end = stream.pos
+    chunks[-1].bytes.append(value)
 
     # Another start bit for the next byte, or a fast cycle for a
     # carrier.
-    try:
-        read_zero(stream)
-        return 'state_byte'
-    except SyncError:
-        read_cycle(stream, 2400)
-        return 'state_carrier'
+    if read_slow_or_fast(stream) == 1200:
+        return state_byte
+    return state_carrier
 
 
 def write_uef(chunks, stream):
-    stream.write(b'UEF File!\x00')  # Magic value.
-    stream.write(b'\x01\x00')       # Version 0.10.
+    # Chunks append themselves to a single buffer, written out in one go.
+    out = bytearray(b'UEF File!\x00')  # Magic value.
+    out += b'\x01\x00'                 # Version 0.10.
 
     for chunk in chunks:
-        chunk.write(stream)
+        chunk.write(out)
+
+    stream.write(out)
+
 
+args = parse_args()
 
 skip_header(sys.stdin.buffer)
-stream = io.BytesIO(sys.stdin.buffer.read())
+stream = SampleStream(sys.stdin.buffer)
 
-state = 'state_sync'
+# Each state returns the next one, or None at the end of the stream.
+state = state_sync
 chunks = []
 while state:
     try:
-        handler = globals().get(state)
-        state = handler(stream, chunks)
-    except SyncError as e:
-        state = 'state_sync'
+        state = state(stream, chunks)
+    except SyncError:
+        state = state_sync
 
 write_uef(chunks, sys.stdout.buffer)
-for chunk in chunks:
-    print(chunk, file=sys.stderr)
+if args.verbose:
+    for chunk in chunks:
+        print(chunk, file=sys.stderr)